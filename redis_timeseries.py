@@ -5,17 +5,19 @@ __email__ = 'ryan.anguiano@gmail.com'
 __version__ = '0.1.9'
 
 
+import bisect
 import calendar
-import functools
-import operator
+import time
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
 
 try:
     import pytz
 except ImportError:  # pragma: no cover
     pytz = None
 
+_UTC = pytz.utc if pytz else None
+
 
 __all__ = ['TimeSeries', 'seconds', 'minutes', 'hours', 'days']
 
@@ -26,6 +28,20 @@ hours = lambda i: i * minutes(60)
 days = lambda i: i * hours(24)
 
 
+EPOCH = datetime(1970, 1, 1)
+
+PREFIX_CACHE_SIZE = 1024
+
+# KEYS: one hash key per granularity
+# ARGV: increment command, amount, then a (bucket, ttl) pair per key
+INCREASE_SCRIPT = """
+for i, hkey in ipairs(KEYS) do
+    redis.call(ARGV[1], hkey, ARGV[i * 2 + 1], ARGV[2])
+    redis.call('EXPIRE', hkey, ARGV[i * 2 + 2])
+end
+"""
+
+
 class TimeSeries(object):
     granularities = OrderedDict([
         ('1minute', {'duration': minutes(1), 'ttl': hours(1)}),
@@ -42,89 +58,116 @@ class TimeSeries(object):
         self.use_float = use_float
         self.timezone = timezone
         self.granularities = granularities or self.granularities
-        self.chain = self.client.pipeline()
+        # Granularities are flattened once here and are fixed after __init__
+        self._gran_items = tuple(
+            (name, props['duration'], props['ttl'])
+            for name, props in self.granularities.items()
+        )
+        self._gran_map = {
+            name: (duration, ttl) for name, duration, ttl in self._gran_items
+        }
+        self.chain = self.client.pipeline(transaction=False)
+        self._increase = self.client.register_script(INCREASE_SCRIPT)
+        self._prefixes = {}
 
     def get_key(self, key, timestamp, granularity):
-        ttl = self.granularities[granularity]['ttl']
+        return self._key_prefix(granularity, timestamp) + str(key)
+
+    def _key_prefix(self, granularity, timestamp):
+        ttl = self._gran_map[granularity][1]
         timestamp_key = round_time(timestamp, ttl)  # No timezone offset in the key
-        return ':'.join([self.base_key, granularity, str(timestamp_key), str(key)])
+        cache_key = (self.base_key, granularity, timestamp_key)
+        try:
+            return self._prefixes[cache_key]
+        except KeyError:
+            if len(self._prefixes) >= PREFIX_CACHE_SIZE:
+                self._prefixes.clear()
+            prefix = '%s:%s:%s:' % cache_key
+            self._prefixes[cache_key] = prefix
+            return prefix
+
+    def _group_by_key(self, granularity, buckets):
+        ttl = self._gran_map[granularity][1]
+        groups = []
+        while buckets:
+            split = bisect.bisect_left(buckets, round_time(buckets[0], ttl) + ttl)
+            groups.append((self._key_prefix(granularity, buckets[0]), buckets[:split]))
+            buckets = buckets[split:]
+        return groups
 
     def increase(self, key, amount, timestamp=None, execute=True):
-        pipe = self.client.pipeline() if execute else self.chain
-
-        for granularity, props in self.granularities.items():
-            hkey = self.get_key(key, timestamp, granularity)
-            bucket = round_time_with_tz(timestamp, props['duration'], self.timezone)
+        timestamp = _unix_time(timestamp)  # Same clock reading for every granularity
 
-            _incr = pipe.hincrbyfloat if self.use_float else pipe.hincrby
-            _incr(hkey, bucket, amount)
+        hkeys = []
+        args = ['HINCRBYFLOAT' if self.use_float else 'HINCRBY', amount]
+        for granularity, duration, ttl in self._gran_items:
+            hkeys.append(self.get_key(key, timestamp, granularity))
+            args.append(round_time_with_tz(timestamp, duration, self.timezone))
+            args.append(ttl)
 
-            pipe.expire(hkey, props['ttl'])
-
-        if execute:
-            pipe.execute()
+        client = self.client if execute else self.chain
+        self._increase(keys=hkeys, args=args, client=client)
 
     def decrease(self, key, amount, timestamp=None, execute=True):
         self.increase(key, -1 * amount, timestamp, execute)
 
     def execute(self):
-        results = self.chain.execute()
-        self.chain = self.client.pipeline()
-        return results
+        return self.chain.execute()
 
     def get_buckets(self, key, granularity, count, timestamp=None):
-        props = self.granularities[granularity]
-        if count > (props['ttl'] / props['duration']):
-            raise ValueError('Count exceeds granularity limit')
+        buckets, values = self._fetch_raw(key, granularity, count, timestamp)
+        return list(zip(_unix_to_dts(buckets), values))
 
-        pipe = self.client.pipeline()
-        buckets = []
-        rounded = round_time_with_tz(timestamp, props['duration'], self.timezone)
-        bucket = rounded - (count * props['duration'])
+    def _fetch_raw(self, key, granularity, count, timestamp=None):
+        duration, ttl = self._gran_map[granularity]
+        if count > (ttl / duration):
+            raise ValueError('Count exceeds granularity limit')
 
-        for _ in range(count):
-            bucket += props['duration']
-            buckets.append(unix_to_dt(bucket))
-            pipe.hget(self.get_key(key, bucket, granularity), bucket)
+        rounded = round_time_with_tz(timestamp, duration, self.timezone)
+        start = rounded - (count - 1) * duration
+        buckets = list(range(start, rounded + duration, duration))
 
-        _type = float if self.use_float else int
-        parse = lambda x: _type(x or 0)
+        groups = self._group_by_key(granularity, buckets)
+        if len(groups) == 1:
+            prefix, group = groups[0]
+            results = self.client.hmget(prefix + str(key), group)
+        else:
+            pipe = self.client.pipeline(transaction=False)
+            for prefix, group in groups:
+                pipe.hmget(prefix + str(key), group)
+            results = [value for values in pipe.execute() for value in values]
 
-        results = map(parse, pipe.execute())
+        return buckets, [self._parse_result(value) for value in results]
 
-        return list(zip(buckets, results))
+    def _parse_result(self, value):
+        if value is None:
+            return 0.0 if self.use_float else 0
+        return float(value) if self.use_float else int(value)
 
     def get_total(self, *args, **kwargs):
-        return sum([
-            amount for bucket, amount in self.get_buckets(*args, **kwargs)
-        ])
+        buckets, values = self._fetch_raw(*args, **kwargs)
+        return sum(values)
 
     def scan_keys(self, granularity, count, search='*', timestamp=None):
-        props = self.granularities[granularity]
-        if count > (props['ttl'] / props['duration']):
+        duration, ttl = self._gran_map[granularity]
+        if count > (ttl / duration):
             raise ValueError('Count exceeds granularity limit')
 
-        hkeys = set()
-        prefixes = set()
-        rounded = round_time_with_tz(timestamp, props['duration'], self.timezone)
-        bucket = rounded - (count * props['duration'])
-
-        for _ in range(count):
-            bucket += props['duration']
-            hkeys.add(self.get_key(search, bucket, granularity))
-            prefixes.add(self.get_key('', bucket, granularity))
-
-        pipe = self.client.pipeline()
-        for key in hkeys:
-            pipe.keys(key)
-        results = functools.reduce(operator.add, pipe.execute())
-
-        parsed = set()
-        for result in results:
-            result = result.decode('utf-8')
-            for prefix in prefixes:
-                result = result.replace(prefix, '')
-            parsed.add(result)
+        # The range spans less than one TTL, so at most two hash keys
+        last = round_time_with_tz(timestamp, duration, self.timezone)
+        first = last - (count - 1) * duration
+        hkeys = {
+            self._key_prefix(granularity, bucket) + search
+            for bucket in ((first, last) if count > 0 else ())
+        }
+
+        # Keys look like 'base_key:granularity:timestamp_key:key'
+        offset = len(self.base_key) + len(granularity) + 2
+        parsed = {
+            result.decode('utf-8')[offset:].partition(':')[2]
+            for hkey in hkeys
+            for result in self.client.scan_iter(match=hkey, count=1000)
+        }
 
         return sorted(parsed)
 
@@ -139,20 +182,20 @@ class TimeSeries(object):
 
 
 def round_time(dt, precision):
-    seconds = dt_to_unix(dt or tz_now())
-    return int((seconds // precision) * precision)
+    seconds = _unix_time(dt)
+    return seconds - seconds % precision
 
 
 def round_time_with_tz(dt, precision, tz=None):
-    rounded = round_time(dt, precision)
+    seconds = _unix_time(dt)
+    rounded = seconds - seconds % precision
 
     if tz and precision % days(1) == 0:
-        rounded_dt = unix_to_dt(rounded).replace(tzinfo=None)
+        rounded_dt = EPOCH + timedelta(seconds=rounded)  # Naive UTC
         offset = tz.utcoffset(rounded_dt).total_seconds()
         rounded = int(rounded - offset)
 
-        dt = unix_to_dt(dt or tz_now())
-        dt_seconds = (hours(dt.hour) + minutes(dt.minute) + seconds(dt.second))
+        dt_seconds = seconds % days(1)  # Time of day in UTC
         if offset < 0 and dt_seconds < abs(offset):
             rounded -= precision
         elif offset > 0 and dt_seconds >= days(1) - offset:
@@ -161,24 +204,45 @@ def round_time_with_tz(dt, precision, tz=None):
     return rounded
 
 
+def _unix_time(dt):
+    if not dt:
+        return int(time.time())
+    elif isinstance(dt, datetime):
+        return _dt_to_unix(dt)
+    return int(dt)
+
+
 def tz_now():
-    if pytz:
-        return datetime.utcnow().replace(tzinfo=pytz.utc)
+    if _UTC:
+        return datetime.utcnow().replace(tzinfo=_UTC)
     else:
-        return datetime.now()
+        return datetime.utcnow()  # Naive UTC, matching _dt_to_unix() and time.time()
 
 
 def dt_to_unix(dt):
     if isinstance(dt, datetime):
-        dt = calendar.timegm(dt.utctimetuple())
+        dt = _dt_to_unix(dt)
     return dt
 
 
+def _dt_to_unix(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
 def unix_to_dt(dt):
     if isinstance(dt, (int, float)):
-        utc = pytz.utc if pytz else None
         try:
-            dt = datetime.fromtimestamp(dt, utc)
+            dt = datetime.fromtimestamp(dt, _UTC)
         except ValueError:
-            dt = datetime.fromtimestamp(dt / 1000., utc)
+            dt = datetime.fromtimestamp(dt / 1000., _UTC)
     return dt
+
+
+def _unix_to_dts(timestamps):
+    if not _UTC or not timestamps:
+        return [unix_to_dt(timestamp) for timestamp in timestamps]
+    # UTC has no DST, so offsetting the first datetime is exact and much
+    # cheaper than a fromtimestamp() call per bucket
+    first = timestamps[0]
+    start = unix_to_dt(first)
+    return [start + timedelta(seconds=timestamp - first) for timestamp in timestamps]
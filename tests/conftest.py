@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-bench', action='store_true', default=False,
+                     help='run the benchmark tests (requires pytest-benchmark)')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: benchmark test, only run with --run-bench')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-bench'):
+        return
+    skip_bench = pytest.mark.skip(reason='needs --run-bench')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip_bench)
@@ -10,8 +10,11 @@ Tests for `redis_timeseries` module.
 
 from collections import OrderedDict
 from datetime import datetime, timedelta
+import os
+import re
 import pytest
 import pytz
+import redis
 
 import redis_timeseries as timeseries
 
@@ -23,29 +26,59 @@ TEST_GRANULARITIES = OrderedDict([
 
 eastern = pytz.timezone('US/Eastern')
 
+# Fixed reference time for the time-sensitive tests, clear of minute/hour boundaries
+NOW = datetime(2017, 7, 16, 12, 30, 30, tzinfo=pytz.utc)
 
-@pytest.fixture
+# Just after an hourly TTL window boundary, for tests spanning two windows
+TTL_BOUNDARY = datetime(2017, 7, 16, 13, 0, 30, tzinfo=pytz.utc)
+
+# Each pytest-xdist worker (gw0, gw1, ...) gets its own logical database,
+# wrapping around to stay within Redis' default 16
+REDIS_DB = 9 + int(os.environ.get('PYTEST_XDIST_WORKER', 'gw0')[2:]) % 7
+
+POOL = redis.ConnectionPool(db=REDIS_DB, max_connections=32)
+
+CLEANUP_SCRIPT = """
+for _, key in ipairs(redis.call('KEYS', ARGV[1])) do
+    redis.call('DEL', key)
+end
+"""
+
+
+@pytest.fixture(scope='session')
 def redis_client():
-    import redis
-    client = redis.StrictRedis(db=9)
-    client.flushdb()
-    return client
+    return redis.StrictRedis(connection_pool=POOL)
 
 
-# Run all baseline tests with and without timezone
-@pytest.fixture(params=[None, eastern])
-def ts(request, redis_client):
-    return timeseries.TimeSeries(redis_client, 'tests', timezone=request.param, granularities=TEST_GRANULARITIES)
+@pytest.fixture(scope='session')
+def cleanup(redis_client):
+    return redis_client.register_script(CLEANUP_SCRIPT)
+
+
+# Each test writes under its own base key; clear leftovers from earlier runs
+@pytest.fixture
+def base_key(request, cleanup):
+    key = 'tests:' + re.sub(r'\W', '_', request.node.name)
+    cleanup(args=[key + ':*'])
+    return key
 
 
+# Override with @pytest.mark.parametrize('use_float', [True]) for float counters
 @pytest.fixture
-def ts_float(redis_client):
-    return timeseries.TimeSeries(redis_client, 'float_tests', use_float=True, granularities=TEST_GRANULARITIES)
+def use_float():
+    return False
+
+
+# Run all baseline tests with and without timezone
+@pytest.fixture(params=[None, eastern])
+def ts(request, redis_client, base_key, use_float):
+    return timeseries.TimeSeries(redis_client, base_key, use_float=use_float, timezone=request.param,
+                                 granularities=TEST_GRANULARITIES)
 
 
 @pytest.fixture
-def ts_timezone(redis_client):
-    return timeseries.TimeSeries(redis_client, 'timezone_tests', timezone=eastern, granularities=TEST_GRANULARITIES)
+def ts_timezone(redis_client, base_key):
+    return timeseries.TimeSeries(redis_client, base_key, timezone=eastern, granularities=TEST_GRANULARITIES)
 
 
 def test_client_connection(ts):
@@ -63,10 +96,22 @@ def test_record_hit_count(ts):
 
 
 def test_record_hit_datetime(ts):
-    now = timeseries.tz_now()
-    ts.record_hit('event:123', now - timedelta(minutes=1))
-    assert ts.get_total_hits('event:123', '1m', 1, now) == 0
-    assert ts.get_total_hits('event:123', '1m', 2, now) == 1
+    ts.record_hit('event:123', NOW - timedelta(minutes=1))
+    assert ts.get_total_hits('event:123', '1m', 1, NOW) == 0
+    assert ts.get_total_hits('event:123', '1m', 2, NOW) == 1
+
+
+def test_record_hit_expire(ts):
+    ts.record_hit('event:123', NOW)
+    for granularity, props in TEST_GRANULARITIES.items():
+        hkey = ts.get_key('event:123', NOW, granularity)
+        assert 0 < ts.client.ttl(hkey) <= props['ttl']
+
+
+def test_get_key_base_key_change(ts):
+    ts.get_key('event:123', NOW, '1m')
+    ts.base_key = 'other'
+    assert ts.get_key('event:123', NOW, '1m').startswith('other:1m:')
 
 
 def test_record_hit_chain(ts):
@@ -78,18 +123,19 @@ def test_record_hit_chain(ts):
 
 
 def test_get_hits(ts):
-    now = timeseries.tz_now()
-    ts.record_hit('event:123', now - timedelta(minutes=4))
-    ts.record_hit('event:123', now - timedelta(minutes=2))
-    ts.record_hit('event:123', now - timedelta(minutes=1))
-    ts.record_hit('event:123')
-    hits = ts.get_hits('event:123', '1m', 5)
+    t1, t2, t4 = [NOW - timedelta(minutes=i) for i in (1, 2, 4)]
+    ts.record_hit('event:123', t4, execute=False)
+    ts.record_hit('event:123', t2, execute=False)
+    ts.record_hit('event:123', t1, execute=False)
+    ts.record_hit('event:123', NOW, execute=False)
+    ts.execute()
+    hits = ts.get_hits('event:123', '1m', 5, NOW)
     assert len(hits) == 5
     assert len(hits[0]) == 2
     assert isinstance(hits[0][0], datetime)
     assert isinstance(hits[0][1], int)
 
-    first_event = timeseries.unix_to_dt(timeseries.round_time(now - timedelta(minutes=4), timeseries.minutes(1)))
+    first_event = timeseries.unix_to_dt(timeseries.round_time(t4, timeseries.minutes(1)))
     assert hits[0][0] == first_event
 
     assert hits[0][1] == 1
@@ -99,35 +145,60 @@ def test_get_hits(ts):
     assert hits[4][1] == 1
 
 
+def test_get_hits_bucket_datetimes(ts):
+    hits = ts.get_hits('event:123', '1m', 60, TTL_BOUNDARY)
+    assert [bucket for bucket, count in hits] == [
+        timeseries.unix_to_dt(timeseries.round_time(TTL_BOUNDARY - timedelta(minutes=i), timeseries.minutes(1)))
+        for i in reversed(range(60))
+    ]
+
+
+def test_get_hits_ttl_boundary(ts):
+    ts.record_hit('event:123', TTL_BOUNDARY - timedelta(minutes=1))
+    ts.record_hit('event:123', TTL_BOUNDARY, count=2)
+    hits = ts.get_hits('event:123', '1m', 3, TTL_BOUNDARY)
+    assert [count for bucket, count in hits] == [0, 1, 2]
+
+
 def test_get_hits_invalid_count(ts):
     with pytest.raises(ValueError):
         ts.get_hits('event:123', '1m', 100)
 
 
 def test_get_total_hits(ts):
-    now = timeseries.tz_now()
-    ts.record_hit('event:123', now - timedelta(minutes=4))
-    ts.record_hit('event:123', now - timedelta(minutes=2))
-    ts.record_hit('event:123', now - timedelta(minutes=1))
-    ts.record_hit('event:123')
-    assert ts.get_total_hits('event:123', '1m', 5) == 4
+    t1, t2, t4 = [NOW - timedelta(minutes=i) for i in (1, 2, 4)]
+    ts.record_hit('event:123', t4, execute=False)
+    ts.record_hit('event:123', t2, execute=False)
+    ts.record_hit('event:123', t1, execute=False)
+    ts.record_hit('event:123', NOW, execute=False)
+    ts.execute()
+    assert ts.get_total_hits('event:123', '1m', 5, NOW) == 4
 
 
-def test_get_total_hits_no_pytz(ts):
-    timeseries.pytz, _pytz = None, timeseries.pytz
+def test_get_total_hits_no_pytz(ts, monkeypatch):
+    monkeypatch.setattr(timeseries, 'pytz', None)
+    monkeypatch.setattr(timeseries, '_UTC', None)
+    # Mixes tz_now() timestamps with the no-timestamp path, which must agree
     now = timeseries.tz_now()
-    ts.record_hit('event:123', now - timedelta(minutes=4))
-    ts.record_hit('event:123', now - timedelta(minutes=2))
-    ts.record_hit('event:123', now - timedelta(minutes=1))
-    ts.record_hit('event:123')
+    ts.record_hit('event:123', now - timedelta(minutes=4), execute=False)
+    ts.record_hit('event:123', now - timedelta(minutes=2), execute=False)
+    ts.record_hit('event:123', now - timedelta(minutes=1), execute=False)
+    ts.record_hit('event:123', execute=False)
+    ts.execute()
     assert ts.get_total_hits('event:123', '1m', 5) == 4
-    timeseries.pytz = _pytz
 
 
 def test_scan_keys(ts):
     ts.record_hit('event:123')
     ts.record_hit('event:456')
-    assert ts.scan_keys('1m', 1) == ['event:123', 'event:456']
+    assert set(ts.scan_keys('1m', 1)) == {'event:123', 'event:456'}
+
+
+def test_scan_keys_ttl_boundary(ts):
+    ts.record_hit('event:123', TTL_BOUNDARY - timedelta(minutes=1))
+    ts.record_hit('event:456', TTL_BOUNDARY)
+    assert set(ts.scan_keys('1m', 1, timestamp=TTL_BOUNDARY)) == {'event:456'}
+    assert set(ts.scan_keys('1m', 2, timestamp=TTL_BOUNDARY)) == {'event:123', 'event:456'}
 
 
 def test_scan_keys_invalid_count(ts):
@@ -139,17 +210,17 @@ def test_scan_keys_search(ts):
     ts.record_hit('event:123')
     ts.record_hit('event:456')
     ts.record_hit('enter:123')
-    assert ts.scan_keys('1m', 1, 'event:*') == ['event:123', 'event:456']
+    assert set(ts.scan_keys('1m', 1, 'event:*')) == {'event:123', 'event:456'}
 
 
-def test_float_increase(ts_float):
-    ts = ts_float
+@pytest.mark.parametrize('use_float', [True])
+def test_float_increase(ts):
     ts.increase('account:123', 1.23)
     assert ts.get_total_hits('account:123', '1m', 1) == 1.23
 
 
-def test_float_decrease(ts_float):
-    ts = ts_float
+@pytest.mark.parametrize('use_float', [True])
+def test_float_decrease(ts):
     ts.increase('account:123', 5)
     ts.decrease('account:123', 2.5)
     assert ts.get_total_hits('account:123', '1m', 1) == 2.5
@@ -199,3 +270,20 @@ def test_get_total_hits_days(ts_timezone):
     assert buckets[2][1] == 1
     assert buckets[3][1] == 3
     assert buckets[4][1] == 2
+
+
+def _record_hits(ts, execute):
+    for _ in range(10000):
+        ts.record_hit('event:123', execute=execute)
+    if not execute:
+        ts.execute()
+
+
+@pytest.mark.benchmark(group='record_hit')
+def test_bench_record_hit(benchmark, ts):
+    benchmark.pedantic(_record_hits, args=(ts, True), rounds=3)
+
+
+@pytest.mark.benchmark(group='record_hit')
+def test_bench_record_hit_chain(benchmark, ts):
+    benchmark.pedantic(_record_hits, args=(ts, False), rounds=3)